@@ -1,129 +1,346 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import plotly.colors
 import plotly.graph_objects as go
+import contextlib
+import csv
+import glob
+import io
 import os
+import pickle
+import tempfile
+import threading
 
 # -----------------------------------------------------------------------------
-# DYNAMIC DATA PARSING
+# OPTIONAL PROFILING
 # -----------------------------------------------------------------------------
-def parse_scenarios_from_csv(filepath):
+@st.cache_resource(show_spinner=False)
+def _profile_lock():
     """
-    Parses the irregular CSV structure to extract all scenarios.
-    Locates blocks by finding 'Cumulative Total Cash Flow' and scanning upwards
-    for the Scenario Name and Timeline.
+    Serializes merges into app.prof across sessions. Runs once per process,
+    so it also clears app.prof left by earlier server processes.
     """
     try:
-        # Read without header as the structure is irregular
-        df = pd.read_csv(filepath, header=None)
+        os.remove("app.prof")
     except FileNotFoundError:
-        return None
+        pass
+    return threading.Lock()
 
-    scenarios = {}
+# Marks a thread that is already being profiled, so a fragment called
+# during a full run doesn't start a second, nested profiler
+_profiling_state = threading.local()
+
+@contextlib.contextmanager
+def _profiled():
+    """
+    With PROFILE=1 set, profiles the enclosed block with a fresh profiler and
+    merges its stats into app.prof (view with `snakeviz app.prof`). Also
+    usable as a decorator, so fragment reruns get profiled too.
+    """
+    if not os.environ.get("PROFILE") or getattr(_profiling_state, "active", False):
+        yield
+        return
     
-    # 1. Identify all rows containing the target data label
-    # This finds every block's cumulative data row
+    import cProfile
+    import pstats
+    
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ allows one active profiler; another session's run is
+        # being profiled, so skip this one
+        yield
+        return
+    
+    _profiling_state.active = True
+    try:
+        yield
+    finally:
+        _profiling_state.active = False
+        profiler.disable()
+        with _profile_lock():
+            stats = pstats.Stats(profiler)
+            if os.path.exists("app.prof"):
+                try:
+                    stats.add("app.prof")
+                except Exception:
+                    # Corrupt or from another Python version; start fresh
+                    # rather than mask the run's own exception
+                    stats = pstats.Stats(profiler)
+            stats.dump_stats("app.prof")
+
+# -----------------------------------------------------------------------------
+# DYNAMIC DATA PARSING
+# -----------------------------------------------------------------------------
+def parse_scenarios_from_rows(rows):
+    """
+    Parses the irregular CSV structure (as a list of non-empty rows from
+    csv.reader, matching pd.read_csv's skipping of blank lines) to extract
+    all scenarios. Walks the rows once, remembering the most recent
+    Scenario Name and Timeline header, and emits a scenario at every
+    'Cumulative Total Cash Flow' row.
+    """
+    scenarios = {}
     target_label = "Cumulative Total Cash Flow"
-    cumulative_rows = df.index[df[0].astype(str).str.contains(target_label, na=False)].tolist()
     
-    for row_idx in cumulative_rows:
+    # Scenarios usually share the same timeline; keep one tuple per distinct
+    # timeline and let each scenario reference it
+    timelines = {}
+    
+    # Most recent "Variables" row and quarter header row seen so far
+    variables_idx = -1
+    q_row_idx = -1
+    
+    for row_idx, row in enumerate(rows):
+        if len(row) > 1 and row[1].strip() == 'Variables':
+            variables_idx = row_idx
+        
+        # Check for presence of at least Q1 and Q2 to confirm it's a header
+        if 'Q1' in row and 'Q2' in row:
+            q_row_idx = row_idx
+        
+        if not row or target_label not in row[0]:
+            continue
+        
         # --- A. Find Scenario Name ---
-        # Look upwards for the "Variables" row. The Scenario Name is usually 
-        # the row immediately preceding "Variables".
+        # The Scenario Name is usually the row immediately preceding the
+        # "Variables" row, within 50 rows above this block's data
         scenario_name = f"Scenario {row_idx}" # Fallback name
         
-        # Search up to 50 rows upwards
-        for r in range(row_idx, max(0, row_idx - 50), -1):
-            val = str(df.iloc[r, 1]).strip()
-            if val == 'Variables':
-                # Name is in the row above, column 0
-                potential_name = str(df.iloc[r-1, 0]).strip()
-                if potential_name and potential_name.lower() != 'nan':
-                    scenario_name = potential_name
-                break
+        if max(0, row_idx - 50) < variables_idx:
+            # Name is in the row above, column 0
+            name_row = rows[variables_idx - 1]
+            potential_name = name_row[0].strip() if name_row else ""
+            if potential_name:
+                scenario_name = potential_name
         
         # --- B. Find Timeline (Years & Quarters) ---
-        # Look upwards for the row containing "Q1", "Q2", etc.
-        q_row_idx = -1
-        for r in range(row_idx, max(0, row_idx - 20), -1):
-            row_vals = [str(x) for x in df.iloc[r].values]
-            # Check for presence of at least Q1 and Q2 to confirm it's a header
-            if 'Q1' in row_vals and 'Q2' in row_vals:
-                q_row_idx = r
-                break
-        
-        if q_row_idx != -1:
-            quarters_row = df.iloc[q_row_idx]
-            years_row = df.iloc[q_row_idx - 1] # Years are row above Quarters
-            data_row = df.iloc[row_idx]        # The Cumulative Cash Flow row
-            
-            timeline = []
-            values = []
-            current_year = ""
-            
-            # Iterate columns (skip col 0 which is labels)
-            for c in range(1, len(quarters_row)):
-                y_val = str(years_row[c]).strip()
-                q_val = str(quarters_row[c]).strip()
-                
-                # Update current year if a new one is found (e.g. "CY2024 (2300 units)")
-                if "CY20" in y_val:
-                    current_year = y_val.split(' ')[0] # Extract just "CY2024"
-                
-                # Valid Quarter Column?
-                if q_val in ['Q1', 'Q2', 'Q3', 'Q4']:
-                    # Build Timeline Label
-                    timeline.append(f"{current_year} {q_val}")
-                    
-                    # Extract & Clean Data Value
-                    raw_val = str(data_row[c])
-                    # Remove currency symbols, 'k' for thousands, commas, and '-'
-                    clean_val = raw_val.replace('$', '').replace(',', '').replace('-', '0')
-                    
-                    # Handle 'k' (e.g., $100k -> 100000)
-                    if 'k' in clean_val.lower():
-                        clean_val = clean_val.lower().replace('k', '')
-                        multiplier = 1000
-                    else:
-                        multiplier = 1
-                        
-                    try:
-                        final_val = float(clean_val) * multiplier
-                        values.append(final_val)
-                    except ValueError:
-                        values.append(0.0)
+        # The header row containing "Q1", "Q2", etc. must be within 20 rows
+        if not max(0, row_idx - 20) < q_row_idx:
+            continue
+        
+        quarters_row = rows[q_row_idx]
+        years_row = rows[q_row_idx - 1] # Years are row above Quarters
+        data_row = row                  # The Cumulative Cash Flow row
+        
+        # Pad the other rows to the quarter row's width and strip them once
+        # as numpy string arrays (skip col 0 which is labels)
+        width = len(quarters_row)
+        quarters = np.char.strip(np.array(quarters_row[1:], dtype=str))
+        years = np.char.strip(np.array((years_row + [""] * width)[1:width], dtype=str))
+        data_cells = np.array((data_row + [""] * width)[1:width], dtype=str)
+        
+        is_quarter = np.isin(quarters, ['Q1', 'Q2', 'Q3', 'Q4'])
+        has_year = np.char.find(years, "CY20") >= 0
+        
+        timeline = []
+        current_year = ""
+        
+        # Only visit columns that start a year or are valid quarters
+        for c in np.flatnonzero(has_year | is_quarter):
+            # Update current year if a new one is found (e.g. "CY2024 (2300 units)")
+            if has_year[c]:
+                current_year = years[c].split(' ')[0] # Extract just "CY2024"
             
-            # Store extracted data
-            scenarios[scenario_name] = {
-                "timeline": timeline,
-                "values": values
-            }
+            # Valid Quarter Column? Build Timeline Label
+            if is_quarter[c]:
+                timeline.append(f"{current_year} {quarters[c]}")
+        
+        raw_values = data_cells[is_quarter]
+        
+        # Extract & Clean Data Values for the whole row in one pass.
+        # Remove currency symbols, commas, and '-', then handle 'k'
+        # (e.g., $100k -> 100000)
+        cells = (
+            pd.Series(raw_values, dtype=str).str.strip().str.lower()
+            .str.replace(r'[\$,]', '', regex=True)
+            .str.replace('-', '0', regex=False)
+        )
+        multiplier = np.where(cells.str.contains('k', regex=False), 1000.0, 1.0)
+        values = pd.to_numeric(
+            cells.str.replace('k', '', regex=False), errors='coerce'
+        ).fillna(0.0).to_numpy(dtype=np.float64) * multiplier
+        
+        timeline = tuple(timeline)
+        timeline = timelines.setdefault(timeline, timeline)
+        
+        # Store extracted data, along with the final total the app
+        # needs, so reruns don't recompute it
+        scenarios[scenario_name] = {
+            "timeline": timeline,
+            "values": values,
+            "final": float(values[-1]) if len(values) else None
+        }
             
     return scenarios
 
+# Bump whenever the parser's output changes, so stale on-disk pickles
+# are ignored rather than handed to newer code
+_CACHE_VERSION = 2
+
+@st.cache_data(show_spinner=False)
+def parse_scenarios_from_csv(filepath, mtime=None):
+    """
+    Cached parse of a CSV on disk. `mtime` is only part of the cache key so
+    that edits to the file invalidate the cached result.
+    
+    The parsed scenarios are also pickled to a single `.cache/<name>.pkl`
+    file next to the CSV, stored with the `_CACHE_VERSION`, mtime and size
+    they were parsed for, so a fresh process can skip the parse.
+    """
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    
+    basename = os.path.basename(filepath)
+    cache_dir = os.path.join(os.path.dirname(filepath), ".cache")
+    cache_path = os.path.join(cache_dir, f"{basename}.pkl")
+    cache_key = (_CACHE_VERSION, stat.st_mtime, stat.st_size)
+    try:
+        with open(cache_path, "rb") as f:
+            cached_key, cached_scenarios = pickle.load(f)
+        if cached_key == cache_key:
+            return cached_scenarios
+    except Exception:
+        # Missing, truncated, or written by incompatible library versions
+        # (e.g. a different numpy); just parse the CSV again
+        pass
+    
+    with open(filepath, newline='', encoding='utf-8-sig') as f:
+        scenarios = parse_scenarios_from_rows([r for r in csv.reader(f) if r])
+    try:
+        # Write to a temp file and move it into place, so concurrent readers
+        # never see a partially written pickle
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump((cache_key, scenarios), f)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        
+        # Clear out pickles left by the old one-file-per-key layout
+        for stale_path in glob.glob(os.path.join(cache_dir, f"{glob.escape(basename)}.*.pkl")):
+            os.remove(stale_path)
+    except OSError:
+        # Read-only deployments just go without the disk cache
+        pass
+    return scenarios
+
+@st.cache_data(show_spinner=False)
+def parse_scenarios_from_bytes(data: bytes):
+    """
+    Cached parse of an uploaded CSV, keyed by its contents.
+    """
+    text = io.StringIO(data.decode('utf-8-sig'), newline='')
+    return parse_scenarios_from_rows([r for r in csv.reader(text) if r])
+
 # -----------------------------------------------------------------------------
-# STREAMLIT APP
+# CHART
+# -----------------------------------------------------------------------------
+_BASE_LAYOUT = dict(
+    xaxis_title="Timeline",
+    yaxis_title="Cumulative Cost (USD)",
+    yaxis=dict(tickformat="$,.0f"),
+    legend=dict(
+        orientation="h",
+        yanchor="bottom",
+        y=-0.5,
+        xanchor="center",
+        x=0.5,
+        # Legend entries are display-only; selection is driven
+        # by the scenario controls
+        itemclick=False,
+        itemdoubleclick=False
+    ),
+    # Deliberately "closest" rather than "x unified": every scenario is drawn
+    # in one trace, so unified hover would only ever show a single point
+    hovermode="closest",
+    height=600,
+    margin=dict(l=40, r=40, t=80, b=80)
+)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_figure(data, scenarios):
+    """
+    Builds the cumulative cash flow chart for the given tuple of scenario
+    names. Cached so reruns with an unchanged selection reuse the figure;
+    each caller gets its own copy, and only recent selections are kept.
+    """
+    # All scenarios share one WebGL trace, broken apart by None/NaN separators,
+    # which keeps render and hover cost flat as more scenarios are selected
+    palette = plotly.colors.qualitative.Plotly
+    xs, ys, labels, names, colors = [], [], [], [], []
+    separator = np.array([np.nan])
+    
+    # Periods are plotted as integer positions (in first-seen order) with the
+    # labels supplied as tick text, so hover picking compares numbers
+    positions = {}
+    
+    for i, name in enumerate(scenarios):
+        color = palette[i % len(palette)]
+        sc_data = data[name]
+        n = len(sc_data["values"])
+        xs.extend(positions.setdefault(period, len(positions)) for period in sc_data["timeline"])
+        ys.append(sc_data["values"])
+        labels.extend(sc_data["timeline"])
+        names.extend([name] * n)
+        colors.extend([color] * n)
+        
+        # Separator so the line doesn't join consecutive scenarios
+        xs.append(None)
+        ys.append(separator)
+        labels.append(None)
+        names.append(None)
+        colors.append(color)
+    
+    fig = go.Figure()
+    fig.add_trace(go.Scattergl(
+        x=xs,
+        y=np.concatenate(ys) if ys else [],
+        mode='lines+markers',
+        line=dict(width=3, color="rgba(128, 128, 128, 0.5)"),
+        marker=dict(size=8, color=colors),
+        text=labels,
+        customdata=names,
+        showlegend=False,
+        hovertemplate="<b>%{customdata}</b><br>%{text}<br>Total: $%{y:,.0f}<extra></extra>"
+    ))
+    
+    # Empty traces that only supply the legend entries. Scenarios are told
+    # apart by marker colour (the shared line is grey), so the legend only
+    # shows markers
+    for i, name in enumerate(scenarios):
+        color = palette[i % len(palette)]
+        fig.add_trace(go.Scattergl(
+            x=[None],
+            y=[None],
+            mode='markers',
+            name=name,
+            marker=dict(size=8, color=color)
+        ))
+
+    fig.update_layout(title="Cumulative Cash Flow Projection", **_BASE_LAYOUT)
+    fig.update_xaxes(tickmode='array', tickvals=list(positions.values()), ticktext=list(positions))
+    
+    return fig
+
 # -----------------------------------------------------------------------------
-st.set_page_config(page_title="Purchase Plan Cash Flow", layout="wide")
-
-st.title("FY27 Purchase Plan: Cumulative Cash Flow")
-st.markdown("### Scenario Comparison")
-
-# --- FILE LOADING ---
-# Try to load the specific file automatically
-default_file = 'FY27 Purchase Plan (Brandon).csv'
-data = parse_scenarios_from_csv(default_file)
-
-if not data:
-    st.error(f"Could not find '{default_file}'. Please ensure the file is in the same directory.")
-    uploaded_file = st.file_uploader("Or upload the file manually:", type=['csv'])
-    if uploaded_file:
-        # Save temp to parse
-        with open("temp_upload.csv", "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        data = parse_scenarios_from_csv("temp_upload.csv")
-
-# --- VISUALIZATION ---
-if data:
+# DASHBOARD
+# -----------------------------------------------------------------------------
+@st.fragment
+@_profiled()
+def render_dashboard(data):
+    """
+    Scenario controls, metrics, chart and data table. Runs as a fragment so
+    changing the selection only reruns this block, not the file loading.
+    Fragment reruns skip the module-level profiler, so it's applied here too.
+    """
     # --- CONTROLS ---
     col1, col2 = st.columns([1, 4])
     
@@ -133,12 +350,7 @@ if data:
         st.write(f"**Found {len(data)} Scenarios**")
         
         all_scenarios = list(data.keys())
-        selected_scenarios = []
-        
-        st.write("Select Scenarios:")
-        for sc in all_scenarios:
-            if st.checkbox(sc, value=True):
-                selected_scenarios.append(sc)
+        selected_scenarios = st.multiselect("Select Scenarios:", all_scenarios, default=all_scenarios)
 
     # --- PROCESS DATA FOR PLOTTING ---
     plot_data = []
@@ -146,18 +358,15 @@ if data:
     
     for sc_name in selected_scenarios:
         sc_data = data[sc_name]
-        df = pd.DataFrame({
-            "Period": sc_data["timeline"],
-            "Cumulative Cash Flow": sc_data["values"]
-        })
         
         # Store final total for metrics (last value)
-        if not df.empty:
-            final_totals[sc_name] = df["Cumulative Cash Flow"].iloc[-1]
+        if sc_data["final"] is not None:
+            final_totals[sc_name] = sc_data["final"]
             
         plot_data.append({
             "name": sc_name,
-            "df": df
+            "timeline": sc_data["timeline"],
+            "values": sc_data["values"]
         })
 
     with col2:
@@ -178,47 +387,65 @@ if data:
                     st.metric(label=display_name, value=f"${total:,.0f}")
             
             # 2. Main Chart
-            fig = go.Figure()
-            
-            for item in plot_data:
-                df = item["df"]
-                fig.add_trace(go.Scatter(
-                    x=df["Period"],
-                    y=df["Cumulative Cash Flow"],
-                    mode='lines+markers',
-                    name=item["name"],
-                    line=dict(width=3),
-                    hovertemplate=f"<b>{item['name']}</b><br>%{{x}}<br>Total: $%{{y:,.0f}}<extra></extra>"
-                ))
-
-            fig.update_layout(
-                title="Cumulative Cash Flow Projection",
-                xaxis_title="Timeline",
-                yaxis_title="Cumulative Cost (USD)",
-                yaxis=dict(tickformat="$,.0f"),
-                legend=dict(
-                    orientation="h",
-                    yanchor="bottom",
-                    y=-0.5,
-                    xanchor="center",
-                    x=0.5
-                ),
-                hovermode="x unified",
-                height=600,
-                margin=dict(l=40, r=40, t=80, b=80)
-            )
+            fig = build_figure(data, tuple(selected_scenarios))
             
             st.plotly_chart(fig, use_container_width=True)
 
     # --- RAW DATA TABLE ---
     with st.expander("View Consolidated Data Table"):
         if plot_data:
-            # Create a merged dataframe for easy viewing
-            base_df = plot_data[0]["df"][["Period"]].copy()
-            for item in plot_data:
-                temp = item["df"].rename(columns={"Cumulative Cash Flow": item["name"]})
-                base_df = pd.merge(base_df, temp, on="Period", how="left")
+            # Align every scenario on Period in a single concat
+            series = {
+                item["name"]: pd.Series(item["values"], index=item["timeline"]) for item in plot_data
+            }
+            if all(s.index.is_unique for s in series.values()):
+                table = pd.concat(series, axis=1)
+            else:
+                # Repeated period labels (e.g. quarters with no year above
+                # them) can't be aligned by label, so line scenarios up by
+                # position and label rows from the longest timeline
+                table = pd.concat({name: s.reset_index(drop=True) for name, s in series.items()}, axis=1)
+                table.index = list(max((item["timeline"] for item in plot_data), key=len))
+            table.index.name = "Period"
             
-            st.dataframe(base_df.set_index("Period").style.format("${:,.0f}"), use_container_width=True)
-else:
-    st.info("Waiting for data...")
+            # Format as currency on the client via column_config rather than
+            # pandas Styler, which is slow to render in st.dataframe. The
+            # frame stays numeric so column sorting still works, and missing
+            # periods show as empty cells. Note the "dollar" preset always
+            # shows cents (e.g. "$1,234.00"), unlike the whole-dollar metrics;
+            # no column_config format gives whole dollars with separators
+            st.dataframe(
+                table,
+                use_container_width=True,
+                column_config={
+                    name: st.column_config.NumberColumn(format="dollar") for name in table.columns
+                }
+            )
+
+# -----------------------------------------------------------------------------
+# STREAMLIT APP
+# -----------------------------------------------------------------------------
+# Everything below runs inside the optional profiler
+with _profiled():
+    st.set_page_config(page_title="Purchase Plan Cash Flow", layout="wide")
+
+    st.title("FY27 Purchase Plan: Cumulative Cash Flow")
+    st.markdown("### Scenario Comparison")
+
+    # --- FILE LOADING ---
+    # Try to load the specific file automatically
+    default_file = 'FY27 Purchase Plan (Brandon).csv'
+    default_mtime = os.path.getmtime(default_file) if os.path.exists(default_file) else None
+    data = parse_scenarios_from_csv(default_file, default_mtime)
+
+    if not data:
+        st.error(f"Could not find '{default_file}'. Please ensure the file is in the same directory.")
+        uploaded_file = st.file_uploader("Or upload the file manually:", type=['csv'])
+        if uploaded_file:
+            data = parse_scenarios_from_bytes(uploaded_file.getvalue())
+
+    # --- VISUALIZATION ---
+    if data:
+        render_dashboard(data)
+    else:
+        st.info("Waiting for data...")